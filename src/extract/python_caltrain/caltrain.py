@@ -1,24 +1,49 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_left
 import csv
 from collections import defaultdict, namedtuple
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
+import functools
+import os
+import pickle
 import pkg_resources
 import re
+from sys import intern
+import tempfile
+from types import MappingProxyType
 from zipfile import ZipFile
 from enum import Enum, unique
 from io import TextIOWrapper
 
-Train = namedtuple("Train", ["name", "kind", "direction", "stops", "service_windows"])
-Station = namedtuple("Station", ["name", "zone"])
-Stop = namedtuple(
-    "Stop", ["arrival", "arrival_day", "departure", "departure_day", "stop_number"]
+# Besides the stops dict, each train keeps its stop times as parallel tuples
+# in stop order (stop_order, arrival_s, departure_s), with stop_index mapping
+# a Station to its position in them. Use _make_train to build one.
+Train = namedtuple(
+    "Train",
+    [
+        "name",
+        "kind",
+        "direction",
+        "stops",
+        "service_windows",
+        "stop_order",
+        "stop_index",
+        "arrival_s",
+        "departure_s",
+    ],
 )
+Station = namedtuple("Station", ["name", "zone"])
+Stop = namedtuple("Stop", ["arrival_s", "departure_s", "stop_number"])
 ServiceWindow = namedtuple(
     "ServiceWindow", ["id", "name", "start", "end", "days", "removed"]
 )
 
-_BASE_DATE = datetime(1970, 1, 1, 0, 0, 0, 0)
+_NONALNUM_RE = re.compile(r"[^A-Za-z0-9]+")
+
+# GTFS feeds repeat a few hundred distinct time strings across all of
+# stop_times.txt, so resolved times are memoized by their raw string.
+_TIME_CACHE = {}
 
 
 class Trip(namedtuple("Trip", ["departure", "arrival", "duration", "train"])):
@@ -26,9 +51,9 @@ class Trip(namedtuple("Trip", ["departure", "arrival", "duration", "train"])):
         return "[{kind} {name}] Departs: {departs}, Arrives: {arrives} ({duration})".format(
             kind=self.train.kind,
             name=self.train.name,
-            departs=self.departure,
-            arrives=self.arrival,
-            duration=self.duration,
+            departs=_seconds_to_time(self.departure),
+            arrives=_seconds_to_time(self.arrival),
+            duration=timedelta(seconds=self.duration),
         )
 
     def __unicode__(self):
@@ -46,6 +71,7 @@ class Trip(namedtuple("Trip", ["departure", "arrival", "duration", "train"])):
         )
 
 
+@functools.lru_cache(maxsize=1024)
 def _sanitize_name(name):
     """
     Pre-sanitization to increase the likelihood of finding
@@ -56,57 +82,100 @@ def _sanitize_name(name):
 
     :returns: sanitized station name
     """
-    return (
-        "".join(re.split("[^A-Za-z0-9]", name)).lower().replace("station", "").strip()
-    )
+    return _NONALNUM_RE.sub("", name).lower().replace("station", "").strip()
+
+
+def _column_indexes(header, *names):
+    """
+    Resolves the positions of the named columns in a GTFS CSV header,
+    so rows can be read positionally instead of through a dict.
+
+    :param header: the header row of the CSV file
+    :type header: list
+    :param names: the column names to resolve
+
+    :returns: tuple of column indexes, in the order of names
+    """
+    try:
+        return tuple(header.index(name) for name in names)
+    except ValueError as e:
+        raise UnexpectedGTFSLayoutError(str(e))
 
 
 def _resolve_time(t):
     """
-    Resolves the time string into datetime.time. This method
-    is needed because Caltrain arrival/departure time hours
-    can exceed 23 (e.g. 24, 25), to signify trains that arrive
-    after 12 AM. The 'day' variable is incremented from 0 in
-    these situations, and the time resolved back to a valid
-    datetime.time (e.g. 24:30:00 becomes days=1, 00:30:00).
+    Resolves the time string into seconds since the start of the
+    service day. Caltrain arrival/departure time hours can exceed
+    23 (e.g. 24, 25), to signify trains that arrive after 12 AM;
+    these simply resolve past 86400 (e.g. 24:30:00 becomes 88200).
 
     :param t: the time to resolve
     :type t: str or unicode
 
-    :returns: tuple of days and datetime.time
+    :returns: int seconds since the start of the service day
     """
-    hour, minute, second = [int(x) for x in t.split(":")]
-    day, hour = divmod(hour, 24)
-    r = _BASE_DATE + timedelta(hours=hour, minutes=minute, seconds=second)
-    return day, r.time()
+    try:
+        return _TIME_CACHE[t]
+    except KeyError:
+        pass
+    hour, minute, second = t.split(":")
+    r = _TIME_CACHE[t] = int(hour) * 3600 + int(minute) * 60 + int(second)
+    return r
 
 
-def _resolve_duration(start, end):
+@functools.lru_cache(maxsize=4096)
+def _parse_gtfs_date(s):
     """
-    Resolves the duration between two times. Departure/arrival
-    times that exceed 24 hours or cross a day boundary are correctly
-    resolved.
+    Parses a GTFS YYYYMMDD date string by slicing, which is much
+    cheaper than datetime.strptime for this fixed layout.
 
-    :param start: the time to resolve
-    :type start: Stop
-    :param end: the time to resolve
-    :type end: Stop
+    :param s: the date to parse
+    :type s: str or unicode
 
-    :returns: tuple of days and datetime.time
+    :returns: datetime.date
     """
-    start_time = _BASE_DATE + timedelta(
-        hours=start.departure.hour,
-        minutes=start.departure.minute,
-        seconds=start.departure.second,
-        days=start.departure_day,
-    )
-    end_time = _BASE_DATE + timedelta(
-        hours=end.arrival.hour,
-        minutes=end.arrival.minute,
-        seconds=end.arrival.second,
-        days=end.departure_day,
+    return date(int(s[:4]), int(s[4:6]), int(s[6:8]))
+
+
+def _make_train(name, kind, direction, stops, service_windows):
+    """
+    Builds a Train, laying out its stops as parallel tuples in
+    stop order alongside the stops dict.
+
+    :param stops: the stops of the train
+    :type stops: dict of Station to Stop
+
+    :returns: the Train
+    """
+    ordered = sorted(stops.items(), key=lambda item: item[1].stop_number)
+    stop_order = tuple(station for station, _ in ordered)
+    return Train(
+        name=name,
+        kind=kind,
+        direction=direction,
+        stops=stops,
+        service_windows=service_windows,
+        stop_order=stop_order,
+        stop_index={station: i for i, station in enumerate(stop_order)},
+        arrival_s=tuple(stop.arrival_s for _, stop in ordered),
+        departure_s=tuple(stop.departure_s for _, stop in ordered),
     )
-    return end_time - start_time
+
+
+def _seconds_to_time(seconds):
+    """
+    Converts seconds since the start of the service day back into
+    a datetime.time for display, wrapping trains that run past
+    12 AM back onto the clock.
+
+    :param seconds: the seconds since the start of the service day
+    :type seconds: int
+
+    :returns: datetime.time
+    """
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return time(hour % 24, minute, second)
 
 
 _STATIONS_RE = re.compile(r"^(.+) Caltrain( Station)?$")
@@ -160,10 +229,13 @@ _ALIAS_MAP_RAW = {
 _ALIAS_MAP = {}
 
 for k, v in _ALIAS_MAP_RAW.items():
+    sanitized_k = _sanitize_name(k)
     if not isinstance(v, list) and not isinstance(v, tuple):
         v = (v,)
     for x in v:
-        _ALIAS_MAP[_sanitize_name(x)] = _sanitize_name(k)
+        _ALIAS_MAP[_sanitize_name(x)] = sanitized_k
+
+_ALIAS_MAP = MappingProxyType(_ALIAS_MAP)
 
 
 @unique
@@ -208,6 +280,29 @@ class UnknownStationError(Exception):
     pass
 
 
+# Bump whenever the layout of the pickled data model changes (e.g. the
+# fields of Train, Stop or ServiceWindow), so stale caches get rebuilt.
+_CACHE_FORMAT = 3
+
+
+def _gtfs_source(gtfs_path=None):
+    """
+    Identifies a GTFS zip file by its absolute path, modification
+    time and size, so a cached data model can be matched to the
+    feed it was built from.
+
+    :param gtfs_path: the path of the GTFS zip file
+                      (default the internally stored one)
+    :type gtfs_path: str or unicode
+
+    :returns: tuple of absolute path, mtime and size
+    """
+    if gtfs_path is None:
+        gtfs_path = pkg_resources.resource_filename(__name__, _DEFAULT_GTFS_FILE)
+    stat = os.stat(gtfs_path)
+    return os.path.abspath(gtfs_path), stat.st_mtime, stat.st_size
+
+
 class Caltrain(object):
     def __init__(self, gtfs_path=None):
 
@@ -217,6 +312,9 @@ class Caltrain(object):
         self._unambiguous_stations = {}
         self._service_windows = {}
         self._fares = {}
+        self._trains_by_station = {}
+        self._legs = {}
+        self._gtfs_source = None
 
         self.load_from_gtfs(gtfs_path)
 
@@ -236,13 +334,102 @@ class Caltrain(object):
             gtfs_handle = open(gtfs_path, "rb")
 
         with gtfs_handle as f:
+            self._gtfs_source = _gtfs_source(gtfs_path)
             self._load_from_gtfs(f)
 
+    def save(self, path):
+        """
+        Pickles the built data model to a file, so it can be restored
+        with Caltrain.load without parsing the GTFS zip file again.
+        The file is replaced atomically, so an interrupted save never
+        leaves a truncated cache behind.
+
+        :param path: the path of the file to write
+        :type path: str or unicode
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(
+                    (_CACHE_FORMAT, self._gtfs_source, self),
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, gtfs_path=None):
+        """
+        Restores a data model previously written by Caltrain.save.
+        A ValueError is thrown if the file was written in a different
+        cache format, was built from a different (or since modified)
+        GTFS zip file or doesn't hold a Caltrain object.
+
+        :param path: the path of the pickled data model
+        :type path: str or unicode
+        :param gtfs_path: the path of the GTFS zip file it must have
+                          been built from (default the internally
+                          stored one)
+        :type gtfs_path: str or unicode
+
+        :returns: the restored Caltrain object
+        """
+        with open(path, "rb") as f:
+            cached = pickle.load(f)
+        if not isinstance(cached, tuple) or len(cached) != 3:
+            raise ValueError("not a Caltrain cache: {}".format(path))
+        cache_format, source, c = cached
+        if cache_format != _CACHE_FORMAT or not isinstance(c, cls):
+            raise ValueError("stale Caltrain cache: {}".format(path))
+        if source != _gtfs_source(gtfs_path):
+            raise ValueError("Caltrain cache built from another feed: {}".format(path))
+        return c
+
+    @classmethod
+    def load_or_build(cls, cache_path, gtfs_path=None):
+        """
+        Restores the data model pickled at cache_path, unless it is
+        missing, unreadable, written in another cache format or built
+        from a different GTFS zip file. In that case the data model is
+        built from the GTFS zip file and saved to cache_path for next
+        time.
+
+        :param cache_path: the path of the pickled data model
+        :type cache_path: str or unicode
+        :param gtfs_path: the path of the GTFS zip file to load
+        :type gtfs_path: str or unicode
+
+        :returns: the Caltrain object
+        """
+        try:
+            return cls.load(cache_path, gtfs_path)
+        except (
+            OSError,
+            EOFError,
+            pickle.UnpicklingError,
+            ValueError,
+            AttributeError,
+            ImportError,
+        ):
+            # Missing, truncated, stale or foreign caches are rebuilt.
+            pass
+
+        c = cls(gtfs_path)
+        c.save(cache_path)
+        return c
+
     def _load_from_gtfs(self, handle):
         z = ZipFile(handle)
 
         self.trains, self.stations = {}, {}
         self._service_windows, self._fares = defaultdict(list), {}
+        self._trains_by_station = defaultdict(list)
+        self._legs = {}
 
         # -------------------
         # 1. Record fare data
@@ -252,18 +439,23 @@ class Caltrain(object):
 
         # Create a map if (start, dest) -> price
         with z.open("fare_attributes.txt", "r") as csvfile:
-            fare_reader = csv.DictReader(TextIOWrapper(csvfile))
+            fare_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
+            fare_id, price = _column_indexes(next(fare_reader), "fare_id", "price")
             for r in fare_reader:
-                fare_lookup[r["fare_id"]] = tuple(int(x) for x in r["price"].split("."))
+                dollars, _, cents = r[price].partition(".")
+                fare_lookup[r[fare_id]] = (int(dollars), int(cents) if cents else 0)
 
         # Read in the fare IDs from station X to station Y.
         with z.open("fare_rules.txt", "r") as csvfile:
-            fare_reader = csv.DictReader(TextIOWrapper(csvfile))
+            fare_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
+            fare_id, origin_id, destination_id = _column_indexes(
+                next(fare_reader), "fare_id", "origin_id", "destination_id"
+            )
             for r in fare_reader:
-                if r["origin_id"] == "" or r["destination_id"] == "":
+                if r[origin_id] == "" or r[destination_id] == "":
                     continue
-                k = (int(r["origin_id"]), int(r["destination_id"]))
-                self._fares[k] = fare_lookup[r["fare_id"]]
+                k = (int(r[origin_id]), int(r[destination_id]))
+                self._fares[k] = fare_lookup[r[fare_id]]
 
         # ------------------------
         # 2. Record calendar dates
@@ -271,101 +463,132 @@ class Caltrain(object):
 
         # Record the days when certain trains are active.
         with z.open("calendar.txt", "r") as csvfile:
-            calendar_reader = csv.reader(TextIOWrapper(csvfile))
+            calendar_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
             next(calendar_reader)  # skip the header
             for r in calendar_reader:
-                self._service_windows[r[0]].append(
+                sw_id = intern(r[0])
+                self._service_windows[sw_id].append(
                     ServiceWindow(
-                        id=r[0],
+                        id=sw_id,
                         name=r[1],
-                        start=datetime.strptime(r[-2], "%Y%m%d").date(),
-                        end=datetime.strptime(r[-1], "%Y%m%d").date(),
-                        days=set(i for i, j in enumerate(r[2:9]) if int(j) == 1),
+                        start=_parse_gtfs_date(r[-2]),
+                        end=_parse_gtfs_date(r[-1]),
+                        days=sum(1 << i for i, j in enumerate(r[2:9]) if j == "1"),
                         removed=False,
                     )
                 )
 
         # Find special events/holiday windows where trains are active.
         with z.open("calendar_dates.txt", "r") as csvfile:
-            calendar_reader = csv.reader(TextIOWrapper(csvfile))
+            calendar_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
             next(calendar_reader)  # skip the header
             for r in calendar_reader:
-                when = datetime.strptime(r[1], "%Y%m%d").date()
-                self._service_windows[r[0]].insert(
-                    0,
+                when = _parse_gtfs_date(r[1])
+                sw_id = intern(r[0])
+                self._service_windows[sw_id].append(
                     ServiceWindow(
-                        id=r[0],
+                        id=sw_id,
                         name=r[1],
                         start=when,
                         end=when,
-                        days={when.weekday()},
+                        days=1 << when.weekday(),
                         removed=r[-1] == "2",
-                    ),
+                    )
                 )
 
+        # Put the exceptions ahead of the regular windows, so removed
+        # dates are seen first when looking for trips.
+        for service_windows in self._service_windows.values():
+            service_windows.reverse()
+
         # ------------------
         # 3. Record stations
         # ------------------
         with z.open("stops.txt", "r") as csvfile:
-            trip_reader = csv.DictReader(TextIOWrapper(csvfile))
+            trip_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
+            stop_id, stop_name_col, zone_id = _column_indexes(
+                next(trip_reader), "stop_id", "stop_name", "zone_id"
+            )
             for r in trip_reader:
                 # From observation, non-numeric stop IDs are useless information
                 # that should be skipped.
-                if not r["stop_id"].isdigit():
+                if not r[stop_id].isdigit():
                     continue
-                regex_go_brrr = _STATIONS_RE.match(r["stop_name"])
+                regex_go_brrr = _STATIONS_RE.match(r[stop_name_col])
                 if regex_go_brrr == None:
                     continue
                 stop_name = regex_go_brrr.group(1).strip().upper()
-                self.stations[r["stop_id"]] = {
-                    "name": _RENAME_MAP.get(stop_name, stop_name).title(),
-                    "zone": int(r["zone_id"]) if r["zone_id"] else -1,
-                }
+                self.stations[intern(r[stop_id])] = Station(
+                    name=intern(_RENAME_MAP.get(stop_name, stop_name).title()),
+                    zone=int(r[zone_id]) if r[zone_id] else -1,
+                )
 
         # ---------------------------
         # 4. Record train definitions
         # ---------------------------
+        train_defs, train_stops = {}, {}
         with z.open("trips.txt", "r") as csvfile:
-            train_reader = csv.DictReader(TextIOWrapper(csvfile))
+            train_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
+            trip_id, service_id, direction_id, trip_short_name = _column_indexes(
+                next(train_reader),
+                "trip_id",
+                "service_id",
+                "direction_id",
+                "trip_short_name",
+            )
             for r in train_reader:
-                train_dir = int(r["direction_id"])
-                transit_type = TransitType.from_trip_id(r["trip_id"])
-                service_windows = self._service_windows[r["service_id"]]
-                self.trains[r["trip_id"]] = Train(
-                    name=r["trip_short_name"] if r["trip_short_name"] else r["trip_id"],
+                train_dir = int(r[direction_id])
+                train_id = intern(r[trip_id])
+                transit_type = TransitType.from_trip_id(train_id)
+                service_windows = self._service_windows[intern(r[service_id])]
+                train_defs[train_id] = dict(
+                    name=intern(r[trip_short_name]) if r[trip_short_name] else train_id,
                     kind=transit_type,
                     direction=Direction(train_dir),
-                    stops={},
                     service_windows=service_windows,
                 )
-
-        self.stations = dict(
-            (k, Station(v["name"], v["zone"])) for k, v in self.stations.items()
-        )
+                train_stops[train_id] = {}
 
         # -----------------------
         # 5. Record trip stations
         # -----------------------
         with z.open("stop_times.txt", "r") as csvfile:
-            stop_times_reader = csv.DictReader(TextIOWrapper(csvfile))
+            stop_times_reader = csv.reader(TextIOWrapper(csvfile, newline=""))
+            (
+                trip_id,
+                arrival_time,
+                departure_time,
+                stop_id,
+                stop_sequence,
+            ) = _column_indexes(
+                next(stop_times_reader),
+                "trip_id",
+                "arrival_time",
+                "departure_time",
+                "stop_id",
+                "stop_sequence",
+            )
             for r in stop_times_reader:
-                stop_id = r["stop_id"]
-                train = self.trains[r["trip_id"]]
-                arrival_day, arrival = _resolve_time(r["arrival_time"])
-                departure_day, departure = _resolve_time(r["departure_time"])
-                train.stops[self.stations[stop_id]] = Stop(
-                    arrival=arrival,
-                    arrival_day=arrival_day,
-                    departure=departure,
-                    departure_day=departure_day,
-                    stop_number=int(r["stop_sequence"]),
+                train_stops[r[trip_id]][self.stations[r[stop_id]]] = Stop(
+                    arrival_s=_resolve_time(r[arrival_time]),
+                    departure_s=_resolve_time(r[departure_time]),
+                    stop_number=int(r[stop_sequence]),
                 )
 
+        for k, v in train_defs.items():
+            self.trains[k] = _make_train(stops=train_stops[k], **v)
+
+        # Index the trains serving each station, so lookups between two
+        # stations only consider trains that actually stop at them.
+        for train in self.trains.values():
+            for station in train.stops:
+                self._trains_by_station[station].append(train)
+
         # For display
-        self.stations = dict(
-            ("_".join(re.split("[^A-Za-z0-9]", v.name)).lower(), v)
-            for _, v in self.stations.items()
-        )
+        self.stations = {
+            _NONALNUM_RE.sub("_", v.name).lower().strip("_"): v
+            for v in self.stations.values()
+        }
 
         # For station lookup by string
         self._unambiguous_stations = dict(
@@ -430,44 +653,69 @@ class Caltrain(object):
         a = self.get_station(a) if not isinstance(a, Station) else a
         b = self.get_station(b) if not isinstance(b, Station) else b
 
+        after_date, after_wd = after.date(), after.weekday()
+        after_s = after.hour * 3600 + after.minute * 60 + after.second
+        departures, legs = self._legs_between(a, b)
         possibilities = []
 
-        for name, train in self.trains.items():
+        for departure, arrival, train in legs[bisect_left(departures, after_s) :]:
 
             should_skip = set()
 
             for sw in train.service_windows:
                 in_time_window = (
-                    sw.start <= after.date() <= sw.end and after.weekday() in sw.days
+                    sw.start <= after_date <= sw.end and (sw.days >> after_wd) & 1
                 )
-                stops_at_stations = a in train.stops and b in train.stops
 
-                if not in_time_window or not stops_at_stations or sw.id in should_skip:
+                if not in_time_window or sw.id in should_skip:
                     continue
 
                 if sw.removed:
                     should_skip.add(sw.id)
                     continue
 
-                stop_a = train.stops[a]
-                stop_b = train.stops[b]
-
-                # Check to make sure this train is headed in the right direction.
-                if stop_a.stop_number > stop_b.stop_number:
-                    continue
-
-                # Check to make sure this train has not left yet.
-                if stop_a.departure < after.time():
-                    continue
-
                 possibilities.append(
                     Trip(
-                        departure=stop_a.departure,
-                        arrival=stop_b.arrival,
-                        duration=_resolve_duration(stop_a, stop_b),
+                        departure=departure,
+                        arrival=arrival,
+                        duration=arrival - departure,
                         train=train,
                     )
                 )
 
-        possibilities.sort(key=lambda x: x.departure)
         return possibilities
+
+    def _legs_between(self, a, b):
+        """
+        Returns every ride from stations a to b across all trains,
+        ordered by departure, along with the list of their departure
+        times to bisect on. These are built on first use and cached
+        per pair of stations.
+
+        :param a: the starting station
+        :type a: Station
+        :param b: the destination station
+        :type b: Station
+
+        :returns: tuple of departures and (departure, arrival, train) legs
+        """
+        legs = self._legs.get((a, b))
+        if legs is not None:
+            return legs
+
+        rides = []
+        for train in self._trains_by_station.get(a, ()):
+
+            i = train.stop_index[a]
+            j = train.stop_index.get(b)
+
+            # Check to make sure this train stops at b and is headed in the
+            # right direction.
+            if j is None or i > j:
+                continue
+
+            rides.append((train.departure_s[i], train.arrival_s[j], train))
+
+        rides.sort(key=lambda x: x[0])
+        legs = self._legs[(a, b)] = [ride[0] for ride in rides], rides
+        return legs
@@ -1,10 +1,12 @@
 from rich.pretty import pprint
 from collections import defaultdict
-import datetime
-import functools
+import os
+import numpy as np
 from python_caltrain import Caltrain, TransitType
 
-c = Caltrain()
+c = Caltrain.load_or_build(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "caltrain.pkl")
+)
 
 # {"Station" : [(transportation_method, "Station it's coming from", arrival_time, time_taken)...]
 incoming = defaultdict(list)
@@ -24,59 +26,56 @@ walking = [
     ("San Bruno", "South San Francisco", 39),
     ("22Nd Street", "San Francisco", 30),
 ]
-date = datetime.date(1, 1, 1)
+# {"Station" : [("Station it's a walk away from", minutes)...]}
+walking_neighbors = defaultdict(list)
+for a, b, mins in walking:
+    walking_neighbors[a].append((b, mins))
+    walking_neighbors[b].append((a, mins))
+stations_by_name = {s.name: s for s in c.stations.values()}
 for i in c.trains["114"].stops:
-    for t in c.trains:
-        if c.trains[t].kind in (
+    incoming_i = incoming[i.name]
+    for t in c._trains_by_station[i]:
+        if t.kind in (
             TransitType.something_weird,
             TransitType.weekend_game_train,
         ):
             continue
-        for s in c.trains[t].stops:
-            if s == i:
-                for j in c.trains[t].stops:
-                    if j.name in (
-                        "Gilroy",
-                        "Blossom Hill",
-                        "College Park",
-                        "Morgan Hill",
-                        "San Martin",
-                        "Capitol",
-                    ):
-                        continue
-                    incoming[i.name].append(
-                        (
-                            t,
-                            j.name,
-                            c.trains[t].stops[s].arrival,
-                            (
-                                datetime.datetime.combine(
-                                    date, c.trains[t].stops[s].arrival
-                                )
-                                - datetime.datetime.combine(
-                                    date, c.trains[t].stops[j].arrival
-                                )
-                            ).seconds
-                            / 60,
-                        )
-                    )
-                    if j == i:
-                        break
-            for w in walking:
-                if s.name in w and i.name in w:
-                    incoming[i.name].append(
-                        (
-                            "Walking",
-                            w[0] if w[0] != i.name else w[1],
-                            (
-                                datetime.datetime.combine(
-                                    date, c.trains[t].stops[s].arrival
-                                )
-                                + datetime.timedelta(minutes=w[2])
-                            ).time(),
-                            w[2],
-                        )
-                    )
+        train_name = t.name
+        arrivals = t.arrival_s
+        idx_of_i = t.stop_index[i]
+        arrival_of_i = arrivals[idx_of_i] // 60
+        for idx_of_j, j in enumerate(t.stop_order[:idx_of_i]):
+            if j.name in (
+                "Gilroy",
+                "Blossom Hill",
+                "College Park",
+                "Morgan Hill",
+                "San Martin",
+                "Capitol",
+            ):
+                continue
+            incoming_i.append(
+                (
+                    train_name,
+                    j.name,
+                    arrival_of_i % 1440,  # time of day, wraps past midnight
+                    arrival_of_i - arrivals[idx_of_j] // 60,
+                )
+            )
+    for name, mins in walking_neighbors.get(i.name, ()):
+        # Like the original scan over every train's stops, this also times
+        # the walk from trains arriving at i itself.
+        for s in (stations_by_name.get(name), i):
+            if s is None:
+                continue
+            for t in c._trains_by_station[s]:
+                if t.kind in (
+                    TransitType.something_weird,
+                    TransitType.weekend_game_train,
+                ):
+                    continue
+                arrival = t.arrival_s[t.stop_index[s]] // 60 + mins
+                incoming_i.append(("Walking", name, arrival % 1440, mins))
 
 
 incoming = {k: v for k, v in sorted(incoming.items(), key=lambda item: len(item[1]))}
@@ -109,45 +108,83 @@ ugh = [
 ]
 
 
-@functools.cache
-def topdown_dp(cur, now, mask):
-    if mask == 0:
-        return now  # * utility[cur]
-    if now == 0:
-        return 0
-    ret = 0
-    count = 0
-    cur_cpy = mask
-    while cur_cpy:
-        count += cur_cpy & 1
-        cur_cpy >>= 1
-    print(count)
-    if count < 24:
-        return ret
-    for i in incoming[cur]:
-        ret = max(
-            ret,
-            datetime.timedelta(
-                minutes=topdown_dp(
-                    ugh.index(i[1]),
-                    datetime.datetime.combine(date, i[2])
-                    - datetime.timedelta(minutes=i[3]),
-                    mask & ~(1 << cur),
-                )
-            )  # utility from previous
-            + (now - datetime.datetime.combine(date, i[2])),
-        )  # utility from spending time here
-    if mask >> (cur + 1) & 1:
-        # same as above but symmetricaxb
-        return ret
+# Masks with fewer stations left than this are cut off and worth 0.
+min_visited = 24
+neg_inf = np.iinfo(np.int64).min // 2
+
+
+def reachable_masks(full_mask):
+    # Every mask the DP can reach from full_mask by visiting stations, down to
+    # min_visited bits. Rows are only kept for these, since a table over all
+    # 1 << N masks doesn't fit in memory.
+    masks, frontier = {full_mask}, [full_mask]
+    while frontier:
+        next_frontier = []
+        for mask in frontier:
+            for cur in range(len(ugh)):
+                rest = mask & ~(1 << cur)
+                if rest == mask or rest in masks or rest.bit_count() < min_visited:
+                    continue
+                masks.add(rest)
+                next_frontier.append(rest)
+        frontier = next_frontier
+    return masks
 
 
-incoming = {ugh.index(k): v for k, v in incoming.items()}
+def bottomup_dp(full_mask):
+    # dp[row[mask], cur] is the best (utility from previous - arrival minute)
+    # over the edges into cur, so the utility of being at cur at now_min with
+    # mask left is max(0, now_min + dp[row[mask], cur]).
+    masks = sorted(reachable_masks(full_mask), key=int.bit_count)
+    row = {mask: r for r, mask in enumerate(masks)}
+    dp = np.full((len(masks), len(ugh)), neg_inf, dtype=np.int64)
+    dep_min = arr_min - travel_min
+    for mask in masks:
+        for cur in range(len(ugh)):
+            if not mask >> cur & 1:
+                continue
+            rest = mask & ~(1 << cur)
+            seg = slice(offsets[cur], offsets[cur + 1])
+            prev, dep = prev_idx[seg], dep_min[seg]
+            # Skip edges from already visited stations.
+            visited = np.right_shift(rest, prev) & 1 == 0
+            if rest == 0:
+                util = dep  # * utility[cur]
+            elif rest.bit_count() < min_visited:
+                util = np.zeros_like(dep)
+            else:
+                util = np.where(dep == 0, 0, np.maximum(0, dep + dp[row[rest], prev]))
+            util = (util - arr_min[seg])[~visited]
+            if util.size:
+                dp[row[mask], cur] = util.max()
+    return dp, row
+
+
+# Incoming edges as CSR arrays: the edges into station cur are
+# offsets[cur]:offsets[cur + 1] of prev_idx (index of the station it's coming
+# from), arr_min (arrival minute) and travel_min (minutes taken).
+# Edges from stations outside of ugh (e.g. walking from "San Jose") can't be
+# DP states, so they're dropped here.
+prev_idx, arr_min, travel_min, offsets = [], [], [], [0]
+for k in ugh:
+    for i in incoming.get(k, ()):
+        if i[1] not in ugh:
+            continue
+        prev_idx.append(ugh.index(i[1]))
+        arr_min.append(i[2])
+        travel_min.append(i[3])
+    offsets.append(len(prev_idx))
+prev_idx, arr_min, travel_min, offsets = (
+    np.array(a, dtype=np.int64) for a in (prev_idx, arr_min, travel_min, offsets)
+)
+full_mask = 2 * 2**24 - 1
+now_min = 21 * 60 + 50
+dp, row = bottomup_dp(full_mask)
 print(
     [
-        topdown_dp(end_station, datetime.time(21, 50, 00), 2 * 2**24 - 1)
+        max(0, now_min + int(dp[row[full_mask], end_station]))
         for end_station in [ugh.index(i.name) for i in c.trains["114"].stops]
     ]
 )
 
-# answer = max([topdown_dp(end_station, datetime.time(21, 50, 00), 2*2**24-1) for end_station in [ugh.index(i.name) for i in c.trains["114"].stops]])
+# answer = max(max(0, now_min + int(dp[row[full_mask], end_station])) for end_station in [ugh.index(i.name) for i in c.trains["114"].stops])